@@ -1,7 +1,11 @@
 """Base classes used by the template engine."""
 
 
-import re
+import ast, string, sys
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import islice
+from types import CodeType
 
 from moody.errors import TemplateRenderError
     
@@ -26,9 +30,11 @@ class Context:
         the buffer is shared.
         """
         sub_params = self.params.copy()
-        sub_params.update(params or {})
+        if params:
+            sub_params.update(params)
         sub_meta = self.meta.copy()
-        sub_meta.update(meta or {})
+        if meta:
+            sub_meta.update(meta)
         return Context(sub_params, sub_meta, self.buffer)
         
     def read(self):
@@ -36,7 +42,49 @@ class Context:
         return "".join(self.buffer)
 
 
-RE_NAME = re.compile("^[a-zA-Z_][a-zA-Z_0-9]*$")
+# Translation table that deletes every character allowed in a variable name.
+_NAME_CHARS = dict.fromkeys(map(ord, string.ascii_letters + string.digits + "_"))
+
+
+class SimpleName:
+
+    """A variable name that can be assigned to in a given context."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        """Initializes the SimpleName."""
+        self.name = name
+
+    def __call__(self, context, value):
+        """Assigns the value to the name."""
+        context.params[self.name] = value
+
+
+class TupleName:
+
+    """A sequence of variable names that a value will be expanded into."""
+
+    __slots__ = ("names",)
+
+    def __init__(self, names):
+        """Initializes the TupleName."""
+        self.names = names
+
+    def __call__(self, context, value):
+        """
+        Expands the value into the names.
+
+        Errors use the same wording as python's own unpacking, which the
+        generated code uses.
+        """
+        names = self.names
+        values = tuple(islice(value, len(names) + 1))
+        if len(values) < len(names):
+            raise ValueError("not enough values to unpack (expected {}, got {})".format(len(names), len(values)))
+        if len(values) > len(names):
+            raise ValueError("too many values to unpack (expected {})".format(len(names)))
+        context.params.update(zip(names, values))
 
 
 def name_setter(name):
@@ -50,53 +98,265 @@ def name_setter(name):
         names = [name.strip() for name in name.split(",")]
         if not names[-1]:
             names.pop()
-        def setter(context, value):
-            # Handle variable expansion.
-            value = iter(value)
-            for name_part in names:
-                try:
-                    context.params[name_part] = next(value)
-                except StopIteration:
-                    raise ValueError("Not enough values to unpack.")
-            # Make sure there are no more values.
-            try:
-                next(value)
-            except StopIteration:
-                pass
-            else:
-                raise ValueError("Need more than {} values to unpack.".format(len(names)))
+        setter = TupleName(tuple(names))
     else:
         names = (name,)
-        def setter(context, value):
-            context.params[name] = value
+        setter = SimpleName(name)
     # Make sure that the names are valid.
     for name in names:
-        if not RE_NAME.match(name):
+        if not name or name[0] in string.digits or name.translate(_NAME_CHARS):
             raise ValueError("{!r} is not a valid variable name. Only letters, numbers and undescores are allowed.".format(name))
     # Return the setter.
     return setter
         
         
+# The ast node types of literal expressions. Before python 3.8, literals do not
+# parse as ast.Constant.
+if sys.version_info >= (3, 8):
+    _LITERAL_NODES = (ast.Constant,)
+else:
+    _LITERAL_NODES = tuple(getattr(ast, name) for name in ("Str", "Bytes", "Num", "NameConstant") if hasattr(ast, name))
+
+
+@lru_cache(maxsize=4096)
+def _compile_expression(expression):
+    """
+    Compiles the given python expression, caching the result by source.
+
+    Returns a tuple of (code, name, constant). If the expression is a single
+    variable name, then name is that name. If the expression is a literal, then
+    constant is its string value.
+    """
+    tree = ast.parse(expression, "<string>", "eval")
+    name = None
+    constant = None
+    if isinstance(tree.body, ast.Name):
+        name = tree.body.id
+    elif isinstance(tree.body, _LITERAL_NODES):
+        constant = str(ast.literal_eval(tree.body))
+    return compile(tree, "<string>", "eval"), name, constant
+
+
+class Expression:
+
+    """A compiled python expression."""
+
+    __slots__ = ("code", "name", "constant",)
+
+    def __init__(self, expression):
+        """Initializes the Expression."""
+        self.code, self.name, self.constant = _compile_expression(expression)
+
+    def __call__(self, context):
+        """Evaluates the expression in the given context."""
+        return eval(self.code, context.meta, context.params)
+
+
 def expression_evaluator(expression):
-    expression = compile(expression, "<string>", "eval")
-    def evaluator(context):
-        return eval(expression, context.meta, context.params)
-    return evaluator
+    """
+    Returns a function that will evaluate the given expression in a given context.
+
+    The returned function has a signature of evaluate(context).
+    """
+    return Expression(expression)
+
+
+# Strings longer than this are not interned.
+MAX_INTERNED_STRING_LENGTH = 4096
+
+
+def intern_string(value):
+    """Interns the given string, so that repeated template text shares memory."""
+    if len(value) < MAX_INTERNED_STRING_LENGTH:
+        return sys.intern(value)
+    return value
+
+
+def intern_constants(code):
+    """
+    Returns a copy of the given code object, with all string constants interned.
+
+    Before python 3.8, code objects have no replace() method, so the code object
+    is returned unchanged.
+    """
+    if not hasattr(code, "replace"):
+        return code
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, str):
+            const = intern_string(const)
+        elif isinstance(const, CodeType):
+            const = intern_constants(const)
+        consts.append(const)
+    return code.replace(co_consts=tuple(consts))
+
+
+# Code generators for known node types, keyed by node function.
+NODE_COMPILERS = {}
+
+
+def node_compiler(node_func):
+    """
+    A decorator that registers a code generator for nodes created using
+    partial(node_func, *args).
+
+    The decorated function is called as compile_node(writer, *args), and should
+    write python source that has the same effect as rendering the node.
+    """
+    def decorator(func):
+        NODE_COMPILERS[node_func] = func
+        return func
+    return decorator
+
+
+class CodeWriter:
+
+    """Generates the python source for a compiled template fragment."""
+
+    __slots__ = ("_name", "_lines", "_namespace", "_indent", "_lineno", "linenos",)
+
+    # Nested fragments are rendered by calling out to the fragment, rather than
+    # being inlined, once this indent is reached. This keeps the generated code
+    # clear of python's limit on statically nested blocks.
+    max_inline_indent = 16
+
+    def __init__(self, name):
+        """Initializes the CodeWriter."""
+        self._name = name
+        self._lines = ["def _render(context):"]
+        self._namespace = {
+            "_eval": eval,
+            "_exec": exec,
+            "_str": str,
+        }
+        self._indent = 1
+        self._lineno = None
+        # The template line number of each line of generated source.
+        self.linenos = [None]
+        self.line("_p = context.params")
+        self.line("_m = context.meta")
+        self.line("_w = context.buffer.append")
+
+    def value(self, value):
+        """Makes the given value available to the generated code, returning its name."""
+        name = "_v{}".format(len(self._namespace))
+        self._namespace[name] = value
+        return name
+
+    def expression(self, evaluate):
+        """Returns the source that evaluates the given expression."""
+        if isinstance(evaluate, Expression):
+            source = "_eval({}, _m, _p)".format(self.value(evaluate.code))
+            # Look up plain names directly in the params, only falling back to
+            # eval() for names that resolve to meta or builtins.
+            if evaluate.name:
+                source = "(_p[{0!r}] if {0!r} in _p else {1})".format(evaluate.name, source)
+            return source
+        return "{}(context)".format(self.value(evaluate))
+
+    def target(self, set_name):
+        """
+        Returns the source of an assignment target for the given name setter.
+
+        Tuple names become a native unpacking target. If the name setter is not
+        one of the built-in name types, returns None.
+        """
+        if isinstance(set_name, SimpleName):
+            return "_p[{!r}]".format(set_name.name)
+        if isinstance(set_name, TupleName):
+            return "".join("_p[{!r}], ".format(name) for name in set_name.names).rstrip()
+        return None
+
+    def assign(self, set_name, source):
+        """Writes the source that assigns the result of the given source using a name setter."""
+        target = self.target(set_name)
+        if target:
+            self.line("{} = {}".format(target, source))
+        else:
+            self.line("{}(context, {})".format(self.value(set_name), source))
+
+    def line(self, source):
+        """Writes a line of source."""
+        self._lines.append("    " * self._indent + source)
+        self.linenos.append(self._lineno)
+
+    @contextmanager
+    def block(self, header):
+        """Writes a block header, indenting any lines written within the block."""
+        self.line(header)
+        self._indent += 1
+        start = len(self._lines)
+        yield
+        if len(self._lines) == start:
+            self.line("pass")
+        self._indent -= 1
+
+    def write_call(self, node):
+        """Writes the source that renders the given node by calling it."""
+        self.line("{}(context)".format(self.value(node)))
+
+    def write_node(self, lineno, node):
+        """Writes the source for the given node."""
+        if isinstance(node, partial) and not node.keywords and node.func in NODE_COMPILERS:
+            compile_node = NODE_COMPILERS[node.func]
+            args = node.args
+        else:
+            compile_node = CodeWriter.write_call
+            args = (node,)
+        parent_lineno = self._lineno
+        self._lineno = lineno
+        compile_node(self, *args)
+        self._lineno = parent_lineno
+
+    def write_fragment(self, fragment):
+        """Writes the source for the nodes in the given fragment."""
+        if self._indent >= self.max_inline_indent:
+            self.line("{}._render_compiled(context)".format(self.value(fragment)))
+            return
+        for lineno, node in fragment._nodes:
+            self.write_node(lineno, node)
+
+    def compile(self):
+        """Compiles the generated source, returning the render function."""
+        code = compile("\n".join(self._lines), "<template {}>".format(self._name), "exec")
+        exec(intern_constants(code), self._namespace)
+        return self._namespace["_render"]
 
 
 class TemplateFragment:
 
     """A fragment of a template."""
 
-    __slots__ = ("_nodes", "_name",)
+    __slots__ = ("_nodes", "_name", "_compiled",)
 
     def __init__(self, nodes, name):
         """Initializes the TemplateFragment."""
         self._nodes = nodes
         self._name = name
-    
-    def _render_to_context(self, context):
-        """Renders the template to the given context."""
+        self._compiled = None
+
+    def _compile(self):
+        """
+        Compiles the nodes into a single python render function.
+
+        Returns a tuple of (render, linenos), where linenos gives the template line
+        number of each line of the generated source.
+        """
+        writer = CodeWriter(self._name)
+        writer.write_fragment(self)
+        return writer.compile(), writer.linenos
+
+    def _get_lineno(self, render, linenos, traceback):
+        """Returns the template line number that the given traceback was raised from."""
+        code = render.__code__
+        while traceback:
+            if traceback.tb_frame.f_code is code:
+                return linenos[traceback.tb_lineno - 1]
+            traceback = traceback.tb_next
+        return None
+
+    def _render_nodes(self, context):
+        """Renders the template to the given context by calling each node in turn."""
         for lineno, node in self._nodes:
             try:
                 node(context)
@@ -105,6 +365,40 @@ class TemplateFragment:
             except Exception as ex:
                 raise TemplateRenderError(str(ex), self._name, lineno) from ex
 
+    def _render_compiled(self, context):
+        """Renders the template to the given context using the generated render function."""
+        compiled = self._compiled
+        if compiled is None or compiled is False:
+            try:
+                compiled = self._compile()
+            except (RuntimeError, SyntaxError, MemoryError):
+                # Some fragments, such as very long elif chains, generate code
+                # that python cannot compile. They keep calling their nodes.
+                compiled = ()
+            self._compiled = compiled
+        if not compiled:
+            self._render_nodes(context)
+            return
+        render, linenos = compiled
+        # The generated code has no error handling of its own, so errors are
+        # mapped back to a template line number from the generated source line.
+        try:
+            render(context)
+        except TemplateRenderError:
+            raise
+        except Exception as ex:
+            raise TemplateRenderError(str(ex), self._name, self._get_lineno(render, linenos, ex.__traceback__)) from ex
+
+    def _render_to_context(self, context):
+        """Renders the template to the given context."""
+        # Generating code only pays off for fragments that are rendered more than
+        # once, so the first render calls the nodes directly.
+        if self._compiled is None:
+            self._compiled = False
+            self._render_nodes(context)
+        else:
+            self._render_compiled(context)
+
 
 class Template(TemplateFragment):
 
@@ -124,10 +418,12 @@ class Template(TemplateFragment):
         sub_params = self._params.copy()
         sub_params.update(context.params)
         # Generate the meta.
-        sub_meta = self._meta.copy()
+        sub_meta = context.meta.copy()
+        sub_meta.update(self._meta)
         sub_meta.update(meta)
-        # Generate the sub context.
-        self._render_to_context(context.sub_context(sub_params, sub_meta))
+        # Generate the sub context. The params and meta are already copies, so
+        # there is no need to copy them again with context.sub_context().
+        self._render_to_context(Context(sub_params, sub_meta, context.buffer))
 
     def render(self, **params):
         """Renders the template, returning the string result."""
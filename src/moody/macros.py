@@ -3,7 +3,16 @@
 import re
 from functools import partial
 
-from moody.base import expression_evaluator, name_setter, Template
+from moody.base import expression_evaluator, name_setter, node_compiler, Template
+
+
+# The flags used to compile regex macros.
+RE_MACRO_FLAGS = re.compile("", re.DOTALL).flags
+
+# Regex syntax that depends on the pattern's own group numbering or on it being
+# the whole regex, so the pattern cannot be embedded in a RegexMacroGroup. This
+# covers backreferences, conditional groups and inline flags.
+RE_UNEMBEDDABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]")
 
 
 def regex_macro(regex):
@@ -15,13 +24,109 @@ def regex_macro(regex):
             if match:
                 return func(parser, *match.groups(), **match.groupdict())
             return None
+        wrapper.regex = regex
+        wrapper.func = func
         return wrapper
     return decorator
+
+
+class RegexMacroGroup:
+
+    """
+    A group of regex macros that are matched using a single combined regex.
+
+    The group behaves like a single macro. The first macro in the group whose
+    regex matches the token is used, just as if the macros were tried in turn.
+    """
+
+    __slots__ = ("_macros", "_regex", "_dispatch",)
+
+    def __init__(self, macros):
+        """Initializes the RegexMacroGroup."""
+        self._macros = macros
+        self._regex = re.compile("|".join("({})".format(macro.regex.pattern) for macro in macros), re.DOTALL)
+        # Map the index of each macro's wrapping group to the macro. The macro's
+        # own groups directly follow its wrapping group.
+        self._dispatch = {}
+        group_index = 1
+        for position, macro in enumerate(macros):
+            self._dispatch[group_index] = (position, macro)
+            group_index += macro.regex.groups + 1
+
+    def __call__(self, parser, token):
+        """Runs the first macro in the group that matches the token."""
+        match = self._regex.match(token)
+        if not match:
+            return None
+        group_index = match.lastindex
+        position, macro = self._dispatch[group_index]
+        node = macro.func(parser, *match.groups()[group_index:group_index + macro.regex.groups])
+        if node:
+            return node
+        # The macro declined the token, so try the rest of the group in turn.
+        for macro in self._macros[position + 1:]:
+            node = macro(parser, token)
+            if node:
+                return node
+        return None
+
+
+# The most groups allowed in the regex of a RegexMacroGroup. Before python 3.5,
+# a compiled regex could not have more than 100 groups.
+MAX_GROUP_REGEX_GROUPS = 100
+
+
+def is_combinable(macro):
+    """Checks whether the given macro is a regex macro that can join a RegexMacroGroup."""
+    regex = getattr(macro, "regex", None)
+    if regex is None or not hasattr(macro, "func"):
+        return False
+    return not regex.groupindex and regex.flags == RE_MACRO_FLAGS and not RE_UNEMBEDDABLE.search(regex.pattern)
+
+
+def combine_macros(macros):
+    """
+    Returns the given macros with each run of consecutive regex macros replaced by
+    a RegexMacroGroup.
+
+    Macros whose regex cannot safely be embedded in a larger regex are left as
+    they are. This includes any regex with named groups, backreferences,
+    conditional groups or flags of its own. Runs are split so that no combined
+    regex has more than MAX_GROUP_REGEX_GROUPS groups.
+    """
+    combined = []
+    run = []
+    def end_run():
+        if len(run) > 1:
+            try:
+                combined.append(RegexMacroGroup(tuple(run)))
+            except re.error:
+                combined.extend(run)
+        else:
+            combined.extend(run)
+        del run[:]
+    for macro in macros:
+        if is_combinable(macro):
+            # Each macro adds its own groups, plus the group that wraps it.
+            if sum(run_macro.regex.groups + 1 for run_macro in run) + macro.regex.groups + 1 > MAX_GROUP_REGEX_GROUPS:
+                end_run()
+            run.append(macro)
+        else:
+            end_run()
+            combined.append(macro)
+    end_run()
+    return tuple(combined)
         
         
 def set_node(evaluate, set_name, context):
     """A node that sets a parameter in the context."""
     set_name(context, evaluate(context))
+
+
+@node_compiler(set_node)
+def compile_set_node(writer, evaluate, set_name):
+    """Writes the source for a set node."""
+    writer.assign(set_name, writer.expression(evaluate))
         
 
 @regex_macro("^set\s+(.+?)\s+as\s+(.+?)$")
@@ -33,6 +138,12 @@ def set_macro(parser, expression, name):
 def print_node(evaluate, context):
     """A node that renders an expression without autoescaping."""
     context.buffer.append(str(evaluate(context)))
+
+
+@node_compiler(print_node)
+def compile_print_node(writer, evaluate):
+    """Writes the source for a print node."""
+    writer.line("_w(_str({}))".format(writer.expression(evaluate)))
         
         
 @regex_macro("^print\s+(.+?)$")
@@ -44,6 +155,12 @@ def print_macro(parser, expression):
 def import_node(statement, context):
     """A node that executes the given import expression."""
     exec(statement, context.meta, context.params)
+
+
+@node_compiler(import_node)
+def compile_import_node(writer, statement):
+    """Writes the source for an import node."""
+    writer.line("_exec({}, _m, _p)".format(writer.value(statement)))
         
         
 @regex_macro("(^from\s+.+?\s+import\s+.+?$|^import\s+.+?$)")
@@ -56,10 +173,23 @@ def if_node(clauses, else_block, context):
     """A node that implements an 'if' expression."""
     for evaluate, block in clauses:
         if evaluate(context):
-            block._render_to_context(context)
+            block._render_nodes(context)
             return
     if else_block:
-        else_block._render_to_context(context)
+        else_block._render_nodes(context)
+
+
+@node_compiler(if_node)
+def compile_if_node(writer, clauses, else_block):
+    """Writes the source for an 'if' expression."""
+    keyword = "if"
+    for evaluate, block in clauses:
+        with writer.block("{} {}:".format(keyword, writer.expression(evaluate))):
+            writer.write_fragment(block)
+        keyword = "elif"
+    if else_block:
+        with writer.block("else:"):
+            writer.write_fragment(else_block)
 
 
 RE_IF_CLAUSE = re.compile("^(elif) (.+?)$|^(else)$|^(endif)$")
@@ -95,7 +225,20 @@ def for_node(set_name, evaluate, block, context):
     items = evaluate(context)
     for item in items:
         set_name(context, item)
-        block._render_to_context(context)
+        block._render_nodes(context)
+
+
+@node_compiler(for_node)
+def compile_for_node(writer, set_name, evaluate, block):
+    """Writes the source for a 'for' loop."""
+    target = writer.target(set_name)
+    if target:
+        with writer.block("for {} in {}:".format(target, writer.expression(evaluate))):
+            writer.write_fragment(block)
+    else:
+        with writer.block("for _item in {}:".format(writer.expression(evaluate))):
+            writer.assign(set_name, "_item")
+            writer.write_fragment(block)
 
 
 RE_ENDFOR = re.compile("^endfor$")
@@ -112,6 +255,12 @@ def py_node(code, context):
     exec(code, context.meta, context.params)
 
 
+@node_compiler(py_node)
+def compile_py_node(writer, code):
+    """Writes the source for a py node."""
+    writer.line("_exec({}, _m, _p)".format(writer.value(code)))
+
+
 @regex_macro("^py\s(.+?)$")
 def py_macro(parser, code):
     """Macro that allows arbitrary python to be executed."""
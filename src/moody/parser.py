@@ -1,11 +1,11 @@
 """The main template parser."""
 
-import os, re
+import builtins, os, re
 from functools import partial
 
 from moody.errors import TemplateCompileError
-from moody.base import expression_evaluator, Template, TemplateFragment
-from moody.macros import DEFAULT_MACROS
+from moody.base import expression_evaluator, intern_string, node_compiler, Template, TemplateFragment
+from moody.macros import combine_macros, DEFAULT_MACROS
         
         
 def string_node(value, context):
@@ -15,13 +15,30 @@ def string_node(value, context):
 
 def expression_node(evaluate, context):
     """A node that evaluates and prints the given expression."""
-    value = str(evaluate(context))
-    # Apply autoescaping.
-    autoescape = context.meta.get("__autoescape__")
-    if autoescape:
-        value = autoescape(value)
-    # Write the value.
-    context.buffer.append(value)
+    context.buffer.append(str(evaluate(context)))
+
+
+def escaped_expression_node(evaluate, autoescape, context):
+    """A node that evaluates, escapes and prints the given expression."""
+    context.buffer.append(autoescape(str(evaluate(context))))
+
+
+@node_compiler(string_node)
+def compile_string_node(writer, value):
+    """Writes the source for a string node."""
+    writer.line("_w({!r})".format(value))
+
+
+@node_compiler(expression_node)
+def compile_expression_node(writer, evaluate):
+    """Writes the source for an expression node."""
+    writer.line("_w(_str({}))".format(writer.expression(evaluate)))
+
+
+@node_compiler(escaped_expression_node)
+def compile_escaped_expression_node(writer, evaluate, autoescape):
+    """Writes the source for an escaped expression node."""
+    writer.line("_w({}(_str({})))".format(writer.value(autoescape), writer.expression(evaluate)))
 
 
 RE_TOKEN = re.compile(r"{#.+?#}|{{\s*(.*?)\s*}}|{%\s*(.*?)\s*%}|\n[ \t]*%%[ \t]*([^\n]+)[ \t]*|\n[ \t]*##[ \t]*[^\n]+[ \t]*", re.DOTALL)
@@ -32,25 +49,23 @@ def tokenize(template):
     lineno = 1
     index = 0
     for match in RE_TOKEN.finditer(template):
+        start, end = match.span()
         # Process string tokens.
-        if match.start() > index:
-            string_token = template[index:match.start()]
-            yield lineno, "STRING", string_token
-            lineno += string_token.count("\n")
+        if start > index:
+            yield lineno, "STRING", template[index:start]
+            lineno += template.count("\n", index, start)
         # Process tag tokens.
         expression_token, macro_token, line_macro_token = match.groups()
-        # Process expression tokens.
         if expression_token:
             yield lineno, "EXPRESSION", expression_token
-            lineno += expression_token.count("\n")
         elif macro_token:
             yield lineno, "MACRO", macro_token
-            lineno += macro_token.count("\n")
         elif line_macro_token:
-            yield lineno, "MACRO", line_macro_token
-            lineno += 1
-        # Update the index.
-        index = match.end()
+            # Line macros match from the newline before them.
+            yield lineno + 1, "MACRO", line_macro_token
+        # Update the index, counting lines over the whole tag, including comments.
+        lineno += template.count("\n", start, end)
+        index = end
     # Yield the final string token.
     yield lineno, "STRING", template[index:]
 
@@ -59,14 +74,15 @@ class ParserRun:
     
     """The state held by a parser during a run."""
     
-    __slots__ = ("tokens", "name", "macros", "meta",)
+    __slots__ = ("tokens", "name", "macros", "meta", "autoescape",)
     
-    def __init__(self, template, name, macros):
+    def __init__(self, template, name, macros, autoescape=None):
         """Initializes the ParserRun."""
         self.tokens = tokenize(template)
         self.name = name
         self.macros = macros
         self.meta = {}
+        self.autoescape = autoescape
     
     def parse_template_chunk(self, end_chunk_handler):
         """
@@ -79,12 +95,32 @@ class ParserRun:
         must then process the nodes and return a result.
         """
         nodes = []
+        # Runs of adjacent strings are collected here, and joined into a single
+        # string node once the run ends.
+        strings = []
+        def end_strings():
+            if strings:
+                nodes.append((strings[0][0], partial(string_node, intern_string("".join(string for _, string in strings)))))
+                del strings[:]
         for lineno, token_type, token_contents in self.tokens:
             try:
+                if token_type == "EXPRESSION":
+                    evaluate = expression_evaluator(token_contents)
+                    # Literal expressions are rendered here, once, as strings.
+                    if evaluate.constant is not None:
+                        token_type = "STRING"
+                        token_contents = evaluate.constant
+                        if self.autoescape:
+                            token_contents = self.autoescape(token_contents)
                 if token_type == "STRING":
-                    node = partial(string_node, token_contents)
+                    if token_contents:
+                        strings.append((lineno, token_contents))
+                    continue
                 elif token_type == "EXPRESSION":
-                    node = partial(expression_node, expression_evaluator(token_contents))
+                    if self.autoescape:
+                        node = partial(escaped_expression_node, evaluate, self.autoescape)
+                    else:
+                        node = partial(expression_node, evaluate)
                 elif token_type == "MACRO":
                     # Process macros.
                     node = None
@@ -93,16 +129,19 @@ class ParserRun:
                         if node:
                             break
                     if not node:
+                        end_strings()
                         return end_chunk_handler(token_contents, nodes)
                 else:
                     assert False, "{!r} is not a valid token type.".format(token_type)
                 # Set the node line number.
+                end_strings()
                 nodes.append((lineno, node))
             except TemplateCompileError:
                 raise
             except Exception as ex:
                 raise TemplateCompileError(str(ex), self.name, lineno) from ex
         # No unknown macro.
+        end_strings()
         return end_chunk_handler(None, nodes)
         
     def parse_all_nodes(self):
@@ -163,7 +202,7 @@ class Parser:
     
     def __init__(self, macros, autoescape_funcs=DEFAULT_AUTOESCAPE_FUNCS):
         """Initializes the Parser."""
-        self._macros = macros
+        self._macros = combine_macros(macros)
         self._autoescape_funcs = autoescape_funcs
         
     def compile(self, template, name="__string__", params=None, meta=None):
@@ -173,6 +212,7 @@ class Parser:
         autoescape = self._autoescape_funcs.get(extension)
         # Compile the meta params.
         default_meta = {
+            "__builtins__": builtins.__dict__,
             "__name__": name,
             "__autoescape__": autoescape,
         }
@@ -180,7 +220,7 @@ class Parser:
         # Get the default params.
         params = params or {}
         # Render the main block.
-        nodes = ParserRun(template, name, self._macros).parse_all_nodes()
+        nodes = ParserRun(template, name, self._macros, default_meta["__autoescape__"]).parse_all_nodes()
         return Template(nodes, name, params, default_meta)
         
         
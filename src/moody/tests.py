@@ -3,6 +3,8 @@ import unittest, sys
 import moody
 from moody.errors import TemplateRenderError, TemplateCompileError
 from moody.loader import TemplateDoesNotExist, MemorySource
+from moody.macros import regex_macro, RegexMacroGroup, DEFAULT_MACROS
+from moody.parser import Parser
 
 
 class TestRender(unittest.TestCase):
@@ -14,16 +16,30 @@ class TestRender(unittest.TestCase):
     def testStringTag(self):
         self.assertEqual(moody.render("Hello world"), "Hello world")
         
+    def testStringMerging(self):
+        template1 = moody.compile("Hello{# A comment. #} world\n## A line comment.\n{% if True %}foo{# A comment. #}bar{% endif %}")
+        self.assertEqual(len(template1._nodes), 2)
+        self.assertEqual(template1.render(), "Hello world\nfoobar")
+        
     def testExpressionTag(self):
         self.assertEqual(moody.render("{{'Hello world'}}"), "Hello world")
         self.assertEqual(moody.render("{{('Hello '\n'world')}}"), "Hello world")
     
+    def testNameLookup(self):
+        self.assertEqual(moody.render("{{test}}", test="foo"), "foo")
+        self.assertEqual(moody.render("{{__name__}}"), "__string__")
+        self.assertEqual(moody.render("{{len}}"), str(len))
+        self.assertRaises(TemplateRenderError, lambda: moody.render("{{test}}"))
+    
     def testSetMacro(self):
         self.assertEqual(moody.render("{% set 'foo' as test %}{{test}}"), "foo")
         self.assertEqual(moody.render("{% set 'foo', 'bar', as test1, test2 %}{{test1}}{{test2}}"), "foobar")
         self.assertEqual(moody.render("{% set 'foo', as test1, %}{{test1}}"), "foo")
         self.assertRaises(TemplateRenderError, lambda: moody.render("{% set 'foo', as foo, bar %}"))
         self.assertRaises(TemplateRenderError, lambda: moody.render("{% set 'foo', 'bar'  as bar, %}"))
+        self.assertRaises(TemplateCompileError, lambda: moody.compile("{% set 'foo' as 1foo %}"))
+        self.assertRaises(TemplateCompileError, lambda: moody.compile("{% set 'foo' as foo-bar %}"))
+        self.assertRaises(TemplateCompileError, lambda: moody.compile("{% set 'foo', 'bar' as foo,,bar %}"))
     
     def testImportMacro(self):
         self.assertEqual(moody.render("{% from operator import add %}{{add(1,1)}}"), "2")
@@ -54,6 +70,13 @@ class TestRender(unittest.TestCase):
         self.assertRaises(TemplateCompileError, lambda: moody.compile("{% if True %}{% else %}{% elif True %}{% endif %}"))
         self.assertRaises(TemplateCompileError, lambda: moody.compile("{% if True %}{% else %}{% else %}{% endif %}"))
     
+    def testLongElifChain(self):
+        # This generates code too deeply nested for python to compile, so the
+        # template keeps rendering by calling its nodes.
+        template1 = moody.compile("{% if n == 0 %}0" + "".join("{{% elif n == {0} %}}{0}".format(n) for n in range(1, 3000)) + "{% endif %}")
+        for n in (0, 2999, 0):
+            self.assertEqual(template1.render(n=n), str(n))
+    
     def testForMacro(self):
         # Test basic functionality.
         template1 = moody.compile("{% for n in range(0, 3) %}{{n}}{% endfor %}")
@@ -65,6 +88,13 @@ class TestRender(unittest.TestCase):
         self.assertEqual(template2.render(value=[["foo", "bar"]]), "foobar")
         self.assertRaises(TemplateRenderError, lambda: template2.render(value=[["foo"]]))
         self.assertRaises(TemplateRenderError, lambda: template2.render(value=[["foo", "bar", "foobar"]]))
+        # The first render calls the nodes, later ones run generated code, and both give the same errors.
+        for value, message in (([["foo"]], "not enough values to unpack (expected 2, got 1)"), ([["foo", "bar", "foobar"]], "too many values to unpack (expected 2)")):
+            template3 = moody.compile("{% for n, m in value %}{{n}}{{m}}{% endfor %}")
+            for _ in range(2):
+                with self.assertRaises(TemplateRenderError) as cm:
+                    template3.render(value=value)
+                self.assertEqual(cm.exception.args[0], message)
     
     def testPyMacro(self):
         template1 = moody.compile("""
@@ -88,6 +118,12 @@ class TestRender(unittest.TestCase):
         template2 = moody.compile("{% include inner %}")
         self.assertEqual(template1.render(), template2.render(inner=template1))
         
+    def testNestedRender(self):
+        template1 = moody.compile("Foo")
+        template2 = moody.compile("{{inner.render()}}{{inner.render()}}")
+        self.assertEqual(template2.render(inner=template1), "FooFoo")
+        self.assertEqual(template1.render(), "Foo")
+        
     def testInheritance(self):
         parent_template = moody.compile("Hello {% block name %}world{% endblock %}")
         child_template = moody.compile("{% extends parent %}{% block name %}Dave {% block surname %}Hall{% endblock %}{% endblock %}")
@@ -112,6 +148,23 @@ class TestRender(unittest.TestCase):
         self.assertEqual(template1.render(test="foo").strip(), "foofoo")
         self.assertEqual(template1.render(test="").strip(), "snafu")
     
+    def testDeeplyNestedTags(self):
+        template1 = moody.compile("{% for n in range(2) %}" * 12 + "{% if True %}x{% endif %}" + "{% endfor %}" * 12)
+        self.assertEqual(template1.render(), "x" * 2 ** 12)
+        self.assertEqual(template1.render(), "x" * 2 ** 12)
+    
+    def testCompiledRender(self):
+        # Templates are rendered by calling their nodes first, and by generated code after that.
+        template1 = moody.compile("""
+            {% import operator %}{% from operator import add %}
+            {% py items = [(1, "a"), (2, "b")] %}
+            {% for n, m in items %}{% if n == 1 %}{{m}}{% elif n == 2 %}{% print add(n, 1) %}{% else %}x{% endif %}{% endfor %}
+            {% set "<b>", as tag, %}{{tag}}{{__name__}}{{len(items)}}{{operator.mul(2, 3)}}
+        """, name="test.html")
+        first = template1.render()
+        self.assertEqual(first.split(), ["a3", "&lt;b&gt;test.html26"])
+        self.assertEqual(template1.render(), first)
+        
     def testLineMacros(self):
         template = moody.compile("""
             %% if test.startswith("foo")
@@ -136,6 +189,41 @@ class TestRender(unittest.TestCase):
     def testAutoescape(self):
         template1 = moody.compile("{{value}}{% print value %}", name="test.html")
         self.assertEqual(template1.render(value="<foo bar='bar' baz=\"baz\">"), "&lt;foo bar=&#x27;bar&#x27; baz=&quot;baz&quot;&gt;<foo bar='bar' baz=\"baz\">")
+        template2 = moody.compile("{{'<foo>'}}{{1}}", name="test.html")
+        self.assertEqual(template2.render(), "&lt;foo&gt;1")
+        self.assertEqual(len(template2._nodes), 1)
+        
+    def testCustomMacros(self):
+        @regex_macro("^(.+?)$")
+        def decline_macro(parser, token):
+            return None
+        def hello_macro(parser, token):
+            if token == "hello":
+                return lambda context: context.buffer.append("Hello")
+        parser = Parser((hello_macro, decline_macro) + DEFAULT_MACROS)
+        self.assertEqual(parser.compile("{% hello %} {% if True %}world{% endif %}").render(), "Hello world")
+        # Macros using backreferences or inline flags work wherever they appear.
+        @regex_macro(r"^twice\s+(\w+)\s+\1$")
+        def twice_macro(parser, name):
+            return lambda context: context.buffer.append("TWICE:" + name)
+        @regex_macro(r"(?s)^flagged$")
+        def flagged_macro(parser):
+            return lambda context: context.buffer.append("FLAGGED")
+        for macros in ((twice_macro, flagged_macro) + DEFAULT_MACROS, DEFAULT_MACROS + (twice_macro, flagged_macro)):
+            parser = Parser(macros)
+            self.assertEqual(parser.compile("{% twice foo foo %} {% flagged %}").render(), "TWICE:foo FLAGGED")
+        # Long runs of regex macros are split to keep each combined regex under the group limit.
+        def make_echo_macro(n):
+            @regex_macro("^echo{}\\s+(\\w+)\\s+(\\w+)$".format(n))
+            def echo_macro(parser, first, second):
+                return lambda context: context.buffer.append(first + second)
+            return echo_macro
+        parser = Parser(tuple(make_echo_macro(n) for n in range(60)) + DEFAULT_MACROS)
+        groups = [macro for macro in parser._macros if isinstance(macro, RegexMacroGroup)]
+        self.assertTrue(len(groups) > 1)
+        for group in groups:
+            self.assertTrue(group._regex.groups <= 100)
+        self.assertEqual(parser.compile("{% echo0 a b %}{% echo59 c d %}{% if True %}e{% endif %}").render(), "abcde")
         
     def testDefaultParams(self):
         template1 = moody.compile("{{test}}", params={"test": "foo"})
@@ -239,6 +327,41 @@ class TestErrorReporting(unittest.TestCase):
             self.assertEqual(ex.template_name, "foo")
             self.assertTrue(isinstance(ex.__cause__, SyntaxError))
             
+    def testNestedRenderErrorLineNumbers(self):
+        template = moody.compile("{% for n in items %}\n{% if n %}\nfoo\n{% elif bar %}\n{{n.foo}}\n{% endif %}\n{% endfor %}", name="foo")
+        # Each case is rendered twice, first by calling the nodes and then by the generated code.
+        for params, lineno in 2 * (({"items": None}, 1), ({"items": [""]}, 2), ({"items": [""], "bar": True}, 5)):
+            try:
+                template.render(**params)
+            except TemplateRenderError as ex:
+                self.assertEqual(ex.template_lineno, lineno)
+                self.assertEqual(ex.template_name, "foo")
+            else:
+                self.fail("TemplateRenderError not raised.")
+            
+    def testCommentLineNumbers(self):
+        for template in ("{# A\nmulti-line comment. #}\n{{foo}}", "Hello\n## A line comment.\n{{foo}}"):
+            try:
+                moody.compile(template, name="foo").render()
+            except TemplateRenderError as ex:
+                self.assertEqual(ex.template_lineno, 3)
+            else:
+                self.fail("TemplateRenderError not raised.")
+        # Line macros report their own line.
+        self.assertRaises(TemplateCompileError, lambda: moody.compile("Hello\nworld\n%% flobble\n"))
+        try:
+            moody.compile("Hello\nworld\n%% flobble\n", name="foo")
+        except TemplateCompileError as ex:
+            self.assertEqual(ex.template_lineno, 3)
+        template = moody.compile("Hello\nworld\n%% set foo as bar\n", name="foo")
+        for _ in range(2):
+            try:
+                template.render()
+            except TemplateRenderError as ex:
+                self.assertEqual(ex.template_lineno, 3)
+            else:
+                self.fail("TemplateRenderError not raised.")
+            
     def testRenderError(self):
         try:
             moody.compile("{% if foo %}\n{{bar}}\n{% else %}\nHello world\n{% endif %}", name="foo").render(foo="foo")